@@ -9,7 +9,11 @@ credentials.json (lo bajas de Google Cloud) y token.json (se genera la primera v
 '''
 
 from __future__ import annotations
+import functools
 import pathlib
+import threading
+import httplib2
+import google_auth_httplib2
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
@@ -26,10 +30,14 @@ CREDENTIALS_FILE = ROOT / "credentials.json"
 TOKEN_FILE = ROOT / "token.json"
 
 # Función para obtener credenciales (login si no hay token o ha caducado)
+@functools.lru_cache(maxsize=1)
 def _get_credentials() -> Credentials:
     """
     Carga token si existe; si no, abre el navegador para iniciar sesión
     y guarda token.json para la próxima.
+    Memoizada: parsear token.json y reconstruir Credentials en cada
+    llamada era trabajo repetido; la librería refresca el token sola
+    cuando caduca.
     """
     creds = None
     if TOKEN_FILE.exists():
@@ -48,12 +56,25 @@ def _get_credentials() -> Credentials:
     return creds
 
 # Funciones para crear clientes de API (service objects)
+# Cacheadas POR HEBRA (httplib2 no es thread-safe): cada hebra reutiliza
+# su cliente y su conexión TCP+TLS con googleapis.com en vez de
+# renegociar el handshake (~50-100ms) en cada llamada.
+_local = threading.local()
+
+def _cached_service(name: str, api: str, version: str):
+    svc = getattr(_local, name, None)
+    if svc is None:
+        authed_http = google_auth_httplib2.AuthorizedHttp(
+            _get_credentials(), http=httplib2.Http(timeout=30)
+        )
+        svc = build(api, version, http=authed_http)
+        setattr(_local, name, svc)
+    return svc
+
 def gmail_service():
     """Cliente para Gmail API listo para usar."""
-    creds = _get_credentials()
-    return build("gmail", "v1", credentials=creds)
+    return _cached_service("gmail", "gmail", "v1")
 
 def sheets_service():
     """Cliente para Google Sheets API listo para usar."""
-    creds = _get_credentials()
-    return build("sheets", "v4", credentials=creds)
+    return _cached_service("sheets", "sheets", "v4")
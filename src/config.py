@@ -29,6 +29,11 @@ class Settings(BaseSettings):
     # Notificaciones (fase 3)
     slack_webhook: str | None = None
 
+    # Hash para dedup de adjuntos: "sha256" (por defecto) o "blake3"
+    # (requiere el paquete blake3; más rápido en adjuntos grandes).
+    # Ojo: cambiarlo invalida las huellas ya guardadas en state.sqlite.
+    fast_hash: str = "sha256"
+
     # Configuraciones de Gmail API
     model_config = SettingsConfigDict(env_file=str(ROOT / ".env"), env_file_encoding="utf-8")
 
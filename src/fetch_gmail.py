@@ -8,8 +8,9 @@
 *API*: primero listamos mensajes (ids), luego pedimos cada mensaje y buscamos sus parts con filename y attachmentId.'''
 
 from __future__ import annotations
-import base64, os, pathlib, datetime as dt
-from typing import List, Dict
+import base64, os, pathlib, threading, datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
 from .auth_gmail import gmail_service
 from .config import settings
 from .state import StateDB, sha256_bytes
@@ -21,6 +22,11 @@ DATA_DIR = settings.data_dir
 INBOX_DIR = settings.inbox_dir
 state = StateDB()
 
+# Workers acotados a 8 para respetar el QPS por usuario de Gmail;
+# el lock protege StateDB (sqlite3 no es thread-safe por defecto).
+MAX_WORKERS = 8
+_state_lock = threading.Lock()
+
 
 # Funciones internas para listar mensajes, obtener mensaje y guardar adjunto
 def _gmail_list_messages(query: str) -> List[Dict]:
@@ -39,21 +45,103 @@ def _gmail_list_messages(query: str) -> List[Dict]:
     log.info(f"Mensajes encontrados: {len(msgs)}")
     return msgs
 
-def _gmail_get_message(msg_id: str) -> Dict:
-    """Recupera el mensaje completo (cabeceras, partes, etc.)."""
+def _gmail_get_message(msg_id: str, fmt: str = "full") -> Dict:
+    """Recupera el mensaje (cabeceras, partes, etc.) en el formato pedido."""
     svc = gmail_service()
-    return svc.users().messages().get(userId="me", id=msg_id).execute()
+    return svc.users().messages().get(userId="me", id=msg_id, format=fmt).execute()
+
+def _gmail_batch_get_messages(msg_ids: List[str], fmt: str = "full") -> Dict[str, Dict]:
+    """
+    Recupera varios mensajes en lotes (BatchHttpRequest): 1 llamada HTTP
+    por cada 100 ids en vez de 1 por mensaje. Devuelve {msg_id: mensaje}.
+    Con fmt="metadata" sólo pide cabeceras (Subject), sin cuerpos.
+    """
+    svc = gmail_service()
+    results: Dict[str, Dict] = {}
+
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            log.error(f"Error recuperando mensaje {request_id}: {exception}")
+            return
+        results[response["id"]] = response
+
+    kwargs = {"format": fmt}
+    if fmt == "metadata":
+        kwargs["metadataHeaders"] = ["Subject"]
 
-def _save_attachment_data(filename: str, data: bytes, subdir: pathlib.Path) -> pathlib.Path:
-    '''Guarda los bytes en un archivo dentro de subdir, evitando sobrescribir.'''
+    # Gmail limita los batches a 100 operaciones
+    for start in range(0, len(msg_ids), 100):
+        batch = svc.new_batch_http_request(callback=_collect)
+        for msg_id in msg_ids[start:start + 100]:
+            batch.add(svc.users().messages().get(userId="me", id=msg_id, **kwargs))
+        batch.execute()
+    return results
+
+def _iter_parts(part: Dict):
+    """
+    Recorre recursivamente el árbol MIME: los adjuntos pueden venir anidados
+    (multipart/mixed → multipart/related → part), no sólo en el primer nivel.
+    """
+    yield part
+    for sub in part.get("parts", []) or ():
+        yield from _iter_parts(sub)
+
+def _looks_like_report(msg: Dict) -> bool:
+    """
+    True si los metadatos del mensaje sugieren un adjunto CSV/XLSX.
+    Las respuestas format=metadata no traen 'parts', así que la señal
+    disponible es el mimeType del payload: los adjuntos viajan siempre
+    en mensajes multipart/*. Con una respuesta completa (hay 'parts')
+    se filtra por nombre de archivo.
+    """
+    payload = msg.get("payload", {})
+    if payload.get("parts"):
+        return any(
+            (p.get("filename") or "").lower().endswith((".csv", ".xlsx"))
+            for p in _iter_parts(payload)
+        )
+    mime = payload.get("mimeType", "")
+    # Sin mimeType no podemos descartar: que decida el fetch completo
+    return not mime or mime.startswith("multipart/")
+
+def _gmail_batch_get_attachments(refs: List[Dict]) -> Dict[str, Dict]:
+    """
+    Descarga varios adjuntos en lotes (BatchHttpRequest): 1 llamada HTTP
+    por cada 100 adjuntos. 'refs' son dicts con {msg_id, att_id}.
+    Devuelve {att_id: respuesta} (la respuesta trae 'data' en base64).
+    """
+    svc = gmail_service()
+    results: Dict[str, Dict] = {}
+
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            log.error(f"Error descargando adjunto {request_id}: {exception}")
+            return
+        results[request_id] = response
+
+    for start in range(0, len(refs), 100):
+        batch = svc.new_batch_http_request(callback=_collect)
+        for ref in refs[start:start + 100]:
+            batch.add(
+                svc.users().messages().attachments().get(
+                    userId="me", messageId=ref["msg_id"], id=ref["att_id"]
+                ),
+                request_id=ref["att_id"],
+            )
+        batch.execute()
+    return results
+
+def _reserve_attachment_path(filename: str, subdir: pathlib.Path) -> pathlib.Path:
+    '''Busca un nombre libre en subdir (evitando sobrescribir) y lo reserva
+    creando el archivo vacío: llamar bajo lock para que dos hebras no elijan
+    la misma ruta. El contenido se escribe después, fuera del lock.'''
     path = subdir / filename
     counter = 1
     stem, ext = os.path.splitext(filename)
-    # Evitar sobrescribir archivos
     while path.exists():
         path = subdir / f"{stem}_{counter}{ext}"
         counter += 1
-    path.write_bytes(data)
+    path.touch()
     return path
 
 # Función principal para buscar correos y descargar adjuntos
@@ -68,18 +156,27 @@ def download_attachments(gmail_query: str | None = None) -> list[pathlib.Path]:
     today_folder.mkdir(parents=True, exist_ok=True)
     saved: list[pathlib.Path] = []
 
-    # Buscar mensajes que cumplan la query
-    for msg in _gmail_list_messages(query):
-        # Obtener el mensaje completo por su ID
-        full = _gmail_get_message(msg["id"])
-        # Extraer asunto y partes del mensaje
+    # Buscar mensajes que cumplan la query. Primera pasada en lotes con
+    # format=metadata (sin cuerpos: mucho menos bytes por el cable) y
+    # segunda pasada completa sólo para los que parecen traer CSV/XLSX.
+    msg_ids = [msg["id"] for msg in _gmail_list_messages(query)]
+    metadata = _gmail_batch_get_messages(msg_ids, fmt="metadata")
+    candidates = [mid for mid, msg in metadata.items() if _looks_like_report(msg)]
+    messages = _gmail_batch_get_messages(candidates, fmt="full")
+
+    # 1) Recorrer mensajes y recolectar referencias a adjuntos CSV/XLSX
+    att_refs: list[Dict] = []
+    for full in messages.values():
         payload = full.get("payload", {})
-        headers = {h["name"].lower(): h["value"] for h in payload.get("headers", [])}
-        subject = headers.get("subject", "(sin asunto)")
+        # Sólo necesitamos Subject: un scan con short-circuit, sin dict intermedio
+        subject = next(
+            (h["value"] for h in payload.get("headers", ()) if h["name"].lower() == "subject"),
+            "(sin asunto)",
+        )
 
-        # Un correo puede tener varias 'parts' (texto, html, adjuntos, etc.)
-        parts = payload.get("parts", [])
-        for part in parts:
+        # Un correo puede tener varias 'parts' (texto, html, adjuntos, etc.),
+        # incluso anidadas: recorremos el árbol MIME completo
+        for part in _iter_parts(payload):
             filename = part.get("filename")
             if not filename:
                 continue
@@ -88,26 +185,65 @@ def download_attachments(gmail_query: str | None = None) -> list[pathlib.Path]:
                 continue
             body = part.get("body", {})
             att_id = body.get("attachmentId")
-            if att_id:
+            if not att_id:
+                continue
+            # Identidad estable del adjunto: si ya lo ingerimos en otro run,
+            # nos ahorramos la descarga y el hash
+            content_id = f"{full['id']}:{filename}:{body.get('size', 0)}"
+            if state.digest_for_content(content_id) is not None:
+                log.info(f"Adjunto ya ingerido, se omite descarga: {filename} (asunto: {subject})")
                 continue
+            att_refs.append({
+                "msg_id": full["id"], "att_id": att_id,
+                "filename": filename, "subject": subject,
+                "content_id": content_id,
+            })
 
-            # Obtener bytes del adjunto
-            svc = gmail_service()
-            att = svc.users().messages().attachments().get(
-                userId="me", messageId=full["id"], id=att_id
-            ).execute()
-            data = base64.urlsafe_b64decode(att["data"].encode("UTF-8"))
-            digest = sha256_bytes(data)
+    # 2) Descargar todos los adjuntos en lotes
+    attachments = _gmail_batch_get_attachments(att_refs)
 
-            # Saltar si ya lo vimos
-            if state.seen(digest):
+    # 3) Decodificar, deduplicar y guardar en local (en paralelo: I/O-bound).
+    # Las filas nuevas se acumulan y se insertan al final con add_many:
+    # una transacción y un fsync para todo el lote.
+    pending_rows: list[tuple] = []
+    run_digests: set[bytes] = set()
+    received_at = dt.datetime.utcnow().isoformat()
+
+    def _process_one(ref: Dict) -> Optional[pathlib.Path]:
+        # pop: soltamos la copia base64 del dict en cuanto la decodificamos
+        # (si no, conviviría con los bytes crudos hasta el final del run)
+        att = attachments.pop(ref["att_id"], None)
+        if att is None:
+            return None  # fallo ya logueado en el callback del batch
+        filename, subject = ref["filename"], ref["subject"]
+        data = base64.urlsafe_b64decode(att["data"].encode("ascii"))
+        del att
+        digest = sha256_bytes(data)
+
+        # Saltar si ya lo vimos, en la BD o en este mismo run (las filas
+        # del run aún no están insertadas: run_digests cubre ese hueco)
+        with _state_lock:
+            if digest in run_digests or state.seen(digest):
+                # Registrar también ESTA identidad: si no, el mismo informe
+                # adjunto a otro correo se re-descargaría en cada run
+                state.map_content(ref["content_id"], digest)
                 log.info(f"Duplicado detectado, se omite: {filename} (asunto: {subject})")
-                continue
+                return None
+            run_digests.add(digest)
+            # Bajo el lock sólo se RESERVA la ruta (el exists() es la parte
+            # con carrera); el write_bytes va fuera para que las hebras
+            # solapen la escritura a disco, que es el grueso del tiempo
+            path = _reserve_attachment_path(filename, today_folder)
+            pending_rows.append((digest, ref["content_id"], filename, str(path), received_at))
+        path.write_bytes(memoryview(data))
+        log.info(f"Descargado: {filename} (asunto: {subject}) → {path}")
+        return path
 
-            path = _save_attachment_data(filename, data, today_folder)
-            state.add(digest, filename, str(path))
-            saved.append(path)
-            log.info(f"Descargado: {filename} (asunto: {subject}) → {path}")
+    if att_refs:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            saved = [p for p in executor.map(_process_one, att_refs) if p is not None]
+        if pending_rows:
+            state.add_many(pending_rows)
 
     if not saved:
         log.warning("No se ha descargado ningún adjunto.")
@@ -1,9 +1,13 @@
 # src/logger.py
 '''
 Logging configurado (consola + archivo rotativo)
+Los handlers reales cuelgan de un QueueListener en su propia hebra:
+el hilo que loguea sólo encola el registro y no espera al disco.
 '''
 
+import atexit
 import logging, logging.handlers
+import queue
 from .config import settings
 
 def get_logger(name: str = "autoreport"):
@@ -18,13 +22,18 @@ def get_logger(name: str = "autoreport"):
     # Consola
     ch = logging.StreamHandler()
     ch.setFormatter(fmt)
-    logger.addHandler(ch)
 
     # Archivo rotativo (5 archivos de 2MB)
     fh = logging.handlers.RotatingFileHandler(
         settings.logs_dir / "run.log", maxBytes=2_000_000, backupCount=5, encoding="utf-8"
     )
     fh.setFormatter(fmt)
-    logger.addHandler(fh)
+
+    # El logger sólo encola; una hebra dedicada formatea y escribe
+    q = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    listener = logging.handlers.QueueListener(q, ch, fh, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # vaciar la cola al salir
 
     return logger
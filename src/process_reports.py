@@ -20,13 +20,43 @@
 '''
 
 from __future__ import annotations
+import os
 import pathlib
+import re
 import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Tuple, Optional
 
+import numpy as np
 import pandas as pd
 import pandera.pandas as pa
 
+# Parsers acelerados opcionales: pyarrow (CSV multihilo) y calamine
+# (XLSX en Rust). Si no están instalados, caemos a los de pandas.
+try:
+    import pyarrow
+    import pyarrow.csv as pa_csv
+except ImportError:  # pragma: no cover
+    pyarrow = None
+    pa_csv = None
+
+try:
+    import xlsxwriter  # noqa: F401  (pandas lo usa vía engine="xlsxwriter")
+    _XLSX_WRITER_KWARGS = {
+        "engine": "xlsxwriter",
+        # constant_memory: vuelca fila a fila en vez de retener toda la hoja
+        "engine_kwargs": {"options": {"constant_memory": True}},
+    }
+except ImportError:  # pragma: no cover
+    _XLSX_WRITER_KWARGS = {}
+
+try:
+    import python_calamine  # noqa: F401  (pandas lo usa vía engine="calamine")
+    _EXCEL_ENGINE = "calamine"
+except ImportError:  # pragma: no cover
+    _EXCEL_ENGINE = None
+
 from .config import settings
 from .logger import get_logger
 
@@ -46,10 +76,24 @@ sin acentos, minúsculas, _ en vez de espacios, etc.
 Por qué: los reportes cambian “Fecha” / “FECHA” / “fecha_pedido”. Normalizar evita errores y simplifica reglas.
 Ejemplo: "Fecha Pedido" → fechapedido → renombrado a canónico fecha.
 '''
+# Tabla directa para las letras acentuadas precompuestas habituales en
+# español: evita pasar por NFKD en el caso común. La tabla de combinantes
+# (U+0300-U+036F) queda como fallback para codepoints no mapeados.
+_PRECOMPOSED_TABLE = str.maketrans(
+    "áéíóúàèìòùäëïöüâêîôûñÁÉÍÓÚÀÈÌÒÙÄËÏÖÜÂÊÎÔÛÑ",
+    "aeiouaeiouaeiouaeiounAEIOUAEIOUAEIOUAEIOUN",
+)
+_ACCENT_TABLE = dict.fromkeys(map(ord, map(chr, range(0x300, 0x370))))
+# Regex precompilada para colapsar espacios/guiones en un solo '_'
+_SEP_RE = re.compile(r"[-_\s]+")
+
 def _strip_accents(s: str) -> str:
-    # Normaliza acentos y eñes -> ascii simple
-    nfkd = unicodedata.normalize("NFKD", s)
-    return "".join(c for c in nfkd if not unicodedata.combining(c))
+    # Normaliza acentos y eñes -> ascii simple (translate corre en C)
+    s = s.translate(_PRECOMPOSED_TABLE)
+    if s.isascii():
+        return s
+    # Codepoints fuera de la tabla: descomponer y borrar combinantes
+    return unicodedata.normalize("NFKD", s).translate(_ACCENT_TABLE)
 
 def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -58,16 +102,12 @@ def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     - pasa a minúsculas
     - reemplaza espacios/guiones por '_'
     - elimina acentos/ñ -> n
+    Ojo: muta el df recibido (el clon único se hace en _process_single_file).
     """
-    new_cols = []
-    for c in df.columns:
-        c2 = str(c).strip().lower()
-        c2 = _strip_accents(c2)
-        c2 = c2.replace(" ", "_").replace("-", "_")
-        c2 = c2.replace("__", "_")
-        new_cols.append(c2)
-    df = df.copy()
-    df.columns = new_cols
+    df.columns = [
+        _SEP_RE.sub("_", _strip_accents(str(c).strip().lower()))
+        for c in df.columns
+    ]
     return df
 
 # ------------------------------------
@@ -97,18 +137,32 @@ SYNONYMS = {
     "monto": {"monto", "importe", "amount"},
 }
 
+# Lookup inverso precomputado: variante -> canónico, en una sola pasada
+# por las columnas reales en vez de iterar todo el catálogo por archivo.
+# Si una variante aparece en varios canónicos gana el último (mismo
+# comportamiento que el bucle anterior); hoy pasa con 'importe', que
+# está en 'total' y en 'monto' -> queda mapeada a 'monto'.
+_VARIANT_TO_CANONICAL = {
+    v: canonical for canonical, variants in SYNONYMS.items() for v in variants
+}
+_conflicts = [
+    v for v, n in Counter(v for vs in SYNONYMS.values() for v in vs).items()
+    if n > 1
+]
+if _conflicts:
+    log.warning(f"Sinónimos ambiguos (gana el último definido): {_conflicts}")
+del _conflicts
+
 def standardize_columns(df: pd.DataFrame) -> pd.DataFrame:
     """
     Renombra columnas conocidas a su forma canónica (sin acentos y con '_').
     """
-    rename_map = {}
-    cols = set(df.columns)
-    for canonical, variants in SYNONYMS.items():
-        for v in variants:
-            if v in cols:
-                rename_map[v] = canonical
+    rename_map = {
+        c: _VARIANT_TO_CANONICAL[c]
+        for c in df.columns if c in _VARIANT_TO_CANONICAL
+    }
     if rename_map:
-        df = df.rename(columns=rename_map)
+        df.rename(columns=rename_map, inplace=True)
     return df
 
 def detect_dataset_type(df: pd.DataFrame) -> str:
@@ -143,17 +197,20 @@ Intenta convertir: fechas → datetime, numéricos → float/int, columnas espec
 Por qué: si llegan “30,00” o “30.00” o “30€”, Pandas necesita “entender” los números.
 Ejemplo: si total no existe pero hay cantidad y precio_unitario, se calcula.
 '''
+# Columnas numéricas conocidas (a nivel de módulo: no se reconstruye por archivo)
+NUMERIC_CANDIDATES = {"cantidad", "precio_unitario", "total", "leads", "conversiones", "stock", "monto"}
+
 def coerce_common(df: pd.DataFrame) -> pd.DataFrame:
-    """Conversión genérica: intenta parsear 'fecha*' y números conocidos."""
-    df = df.copy()
-    # Fechas genéricas
-    for col in [c for c in df.columns if c.startswith("fecha")]:
-        df[col] = pd.to_datetime(df[col], errors="coerce", dayfirst=True)
-    # Numéricos comunes
-    numeric_candidates = {"cantidad", "precio_unitario", "total", "leads", "conversiones", "stock", "monto"}
-    for col in df.columns:
-        if col in numeric_candidates:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
+    """Conversión genérica: intenta parsear 'fecha*' y números conocidos.
+    Muta el df recibido (ver _process_single_file)."""
+    # Fechas genéricas (bloque de columnas, conversión despachada por pandas)
+    date_cols = [c for c in df.columns if c.startswith("fecha")]
+    if date_cols:
+        df[date_cols] = df[date_cols].apply(pd.to_datetime, errors="coerce", dayfirst=True)
+    # Numéricos comunes (intersección en vez de chequear columna a columna)
+    num_cols = list(NUMERIC_CANDIDATES & set(df.columns))
+    if num_cols:
+        df[num_cols] = df[num_cols].apply(pd.to_numeric, errors="coerce")
     # Normaliza 'tipo' en finanzas: ingreso/gasto (lower)
     if "tipo" in df.columns:
         df["tipo"] = df["tipo"].astype(str).str.strip().str.lower()
@@ -163,8 +220,8 @@ def coerce_by_type(df: pd.DataFrame, dtype: str) -> pd.DataFrame:
     """
     Ajustes más específicos por tipo de dataset.
     - ventas: si falta 'total' y hay 'cantidad' y 'precio_unitario' -> calcular
+    Muta el df recibido (ver _process_single_file).
     """
-    df = df.copy()
     if dtype == "ventas":
         # Homogeneiza nombre 'fecha'
         if "fechapedido" in df.columns and "fecha" not in df.columns:
@@ -185,6 +242,45 @@ Define esquemas por tipo:
 Por qué: evita que datos corruptos entren al dashboard.
 Qué pasa si falla: ese archivo se aparta a invalid (no contamina el dataset limpio). El log lo indica.
 '''
+# Kernel JIT opcional (numba): una sola pasada multihilo sin temporales,
+# frente a los 5 arrays intermedios de la versión numpy.
+try:
+    from numba import njit, prange
+
+    # Sin fastmath: activaría nnan/ninf y LLVM podría plegar los isnan()
+    # a False, quitándole la exención a las filas con NaN.
+    @njit(parallel=True, cache=True)
+    def _consistencia_kernel(q, p, t):  # pragma: no cover (compilado)
+        out = np.empty(q.size, np.bool_)
+        for i in prange(q.size):
+            out[i] = (
+                np.isnan(q[i]) or np.isnan(p[i]) or np.isnan(t[i])
+                or abs(q[i] * p[i] - t[i]) < 1e-6
+            )
+        return out
+except ImportError:  # pragma: no cover
+    _consistencia_kernel = None
+
+def _ventas_total_consistente(d: pd.DataFrame):
+    """
+    Check vectorizado: total ≈ cantidad*precio_unitario (una sola pasada
+    sobre arrays float64 en vez de encadenar Series booleanas). NaN en
+    cualquiera de las tres columnas no penaliza.
+    """
+    # Si falta alguna de las columnas, no hay nada que comprobar
+    if not {"cantidad", "precio_unitario", "total"} <= set(d.columns):
+        return True
+    q = d["cantidad"].to_numpy(dtype="float64", na_value=np.nan)
+    p = d["precio_unitario"].to_numpy(dtype="float64", na_value=np.nan)
+    t = d["total"].to_numpy(dtype="float64", na_value=np.nan)
+    if _consistencia_kernel is not None:
+        return _consistencia_kernel(q, p, t)
+    return (
+        # rtol=0: tolerancia absoluta pura, igual que el kernel (<1e-6)
+        np.isclose(q * p, t, rtol=0, atol=1e-6)
+        | np.isnan(q) | np.isnan(p) | np.isnan(t)
+    )
+
 VentasSchema = pa.DataFrameSchema(
     {
         "fecha": pa.Column(pa.DateTime, nullable=False),
@@ -196,14 +292,8 @@ VentasSchema = pa.DataFrameSchema(
     # Check de consistencia: si existen cantidad y precio_unitario, total ≈ cantidad*precio_unitario
     checks=[
         pa.Check(
-            lambda d: (
-                # condición válida cuando falte alguna de las columnas
-                (("cantidad" not in d.columns) | ("precio_unitario" not in d.columns) | ("total" not in d.columns)) |
-                # o cuando existen, que total sea cercano al producto
-                ((d["cantidad"] * d["precio_unitario"] - d["total"]).abs() < 1e-6) |
-                # permitir NaN en alguna de las tres
-                (d["cantidad"].isna()) | (d["precio_unitario"].isna()) | (d["total"].isna())
-            ),
+            _ventas_total_consistente,
+            element_wise=False,
             error="total debe ser cantidad*precio_unitario cuando ambas existan"
         )
     ],
@@ -254,8 +344,15 @@ def _schema_for(dtype: str) -> Optional[pa.DataFrameSchema]:
 
 def load_any(path: pathlib.Path) -> pd.DataFrame:
     if path.suffix.lower() == ".csv":
+        if pa_csv is not None:
+            # Parser Arrow multihilo; to_pandas() sin types_mapper para que
+            # el resultado lleve dtypes numpy (los esquemas pandera declaran
+            # pa.String/pa.Float y rechazarían dtypes arrow-backed)
+            return pa_csv.read_csv(str(path)).to_pandas()
         return pd.read_csv(path)
     elif path.suffix.lower() in (".xlsx", ".xls"):
+        if _EXCEL_ENGINE:
+            return pd.read_excel(path, engine=_EXCEL_ENGINE)
         return pd.read_excel(path)
     else:
         raise ValueError(f"Formato no soportado: {path.suffix}")
@@ -264,38 +361,58 @@ def combine_files(files: List[pathlib.Path]) -> pd.DataFrame:
     """
     Une todos los adjuntos en un solo DataFrame crudo (raw), añadiendo __source_file.
     No valida ni limpia: eso se hace luego por archivo.
+    El parseo (CPU-bound) se reparte entre procesos cuando hay varios archivos.
     """
     dfs = []
-    for f in files:
-        try:
-            df = load_any(f)
-            df["__source_file"] = f.name
-            dfs.append(df)
-        except Exception as e:
-            log.error(f"Error leyendo {f.name}: {e}")
+    if len(files) > 1:
+        # Un proceso por archivo (hasta el nº de cores): el parseo domina
+        workers = min(len(files), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_load_or_error, files))
+    else:
+        results = [_load_or_error(f) for f in files]
+    for f, (df, error) in zip(files, results):
+        # El log se emite SIEMPRE en el padre: los hijos del pool heredan
+        # la QueueHandler pero no el hilo del QueueListener, así que lo
+        # que loguean se pierde.
+        if error is not None:
+            log.error(f"Error leyendo {f.name}: {error}")
+            continue
+        df["__source_file"] = f.name
+        dfs.append(df)
     if not dfs:
         return pd.DataFrame()
     raw = pd.concat(dfs, ignore_index=True)
     return raw
 
+def _load_or_error(path: pathlib.Path) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """load_any para executor.map: devuelve (df, None) o (None, error)."""
+    try:
+        return load_any(path), None
+    except Exception as e:
+        return None, str(e)
+
 # -----------------------------------------
 # 6) Limpieza + validación por archivo fuente
 # -----------------------------------------
 
-def _process_single_file(df_file: pd.DataFrame, source_name: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+# Columnas de texto con pocos valores distintos, candidatas a 'category'
+CATEGORICAL_COLUMNS = {"producto", "campana", "categoria", "tipo", "pais", "almacen", "__source_file", "__dataset_type"}
+
+def _prepare_single_file(df_file: pd.DataFrame) -> Tuple[pd.DataFrame, str]:
     """
-    Procesa un único archivo:
+    Prepara un único archivo (sin validar aún):
     - normaliza nombres, estandariza sinónimos
     - detección de tipo
     - coerción de tipos (fechas, numéricos, etc.)
-    - validación con pandera (si aplica)
-    Devuelve: (valid_rows, invalid_rows)
+    Devuelve: (df_preparado, tipo_detectado)
     """
-    if df_file.empty:
-        return df_file, pd.DataFrame()
+    # Clon único: de aquí en adelante las funciones mutan in place
+    # (evita materializar el frame en cada paso)
+    df = df_file.copy()
 
     # Normaliza y estandariza columnas
-    df = normalize_columns(df_file)
+    df = normalize_columns(df)
     df = standardize_columns(df)
 
     # Detecta el tipo y aplica conversión
@@ -306,45 +423,32 @@ def _process_single_file(df_file: pd.DataFrame, source_name: str) -> Tuple[pd.Da
     # Adjunta metadatos
     df["__dataset_type"] = dtype
     df["__validation_ok"] = True
+    return df, dtype
 
-    schema = _schema_for(dtype)
-    if schema is None:
-        # 'generico': no validamos estricto
-        return df, pd.DataFrame()
-
-    # Validación
+def _annotate_invalid(df_invalid: pd.DataFrame, failure: pd.DataFrame) -> pd.DataFrame:
+    """Marca un bloque como inválido y le adjunta un resumen de fallos."""
     try:
-        df_valid = schema.validate(df, lazy=True)
-        return df_valid, pd.DataFrame()
-    except pa.errors.SchemaErrors as err:
-        # Extrae filas problemáticas (tabla de fallos)
-        failure = err.failure_cases.copy()
-        # failure típicamente tiene: schema_context, column, check, failure_case, index
-        failure["__source_file"] = source_name
-        failure["__dataset_type"] = dtype
-
-        # Marcamos todo el df como invalidado para trazabilidad
-        try:
-            df_invalid = df.copy()
-            df_invalid["__validation_ok"] = False
-            df_invalid["__validation_error_rows"] = len(failure.index.unique())
-            # Resumen textual de problemas más comunes (hasta 3 ejemplos por check)
-            top_err = (
-                failure.groupby(["column", "check"])["failure_case"]
-                .apply(lambda s: ", ".join(map(str, s.head(3))))
-                .reset_index()
-            )
-            df_invalid["__validation_summary"] = "; ".join(
-                f"{r['column']}→{r['check']} (ej: {r['failure_case']})" for _, r in top_err.iterrows()
-            )
-        except Exception:
-            df_invalid = df.assign(__validation_ok=False)
-
-        return pd.DataFrame(), df_invalid
+        df_invalid = df_invalid.copy()
+        df_invalid["__validation_ok"] = False
+        df_invalid["__validation_error_rows"] = len(failure["index"].unique())
+        # Resumen textual de problemas más comunes (hasta 3 ejemplos por check)
+        top_err = (
+            failure.groupby(["column", "check"])["failure_case"]
+            .apply(lambda s: ", ".join(map(str, s.head(3))))
+            .reset_index()
+        )
+        df_invalid["__validation_summary"] = "; ".join(
+            f"{r['column']}→{r['check']} (ej: {r['failure_case']})" for _, r in top_err.iterrows()
+        )
+    except Exception:
+        df_invalid = df_invalid.assign(__validation_ok=False)
+    return df_invalid
 
 def clean_and_validate(raw_combined: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Separa por archivo de origen y procesa cada uno.
+    Prepara cada archivo por separado, pero valida UNA vez por tipo de
+    dataset: los archivos del mismo tipo se concatenan y pasan juntos por
+    pandera (el overhead de schema.validate se paga por tipo, no por archivo).
     Devuelve:
       - df_clean: unión de todos los archivos que PASARON validación
       - df_invalid: unión de archivos (completos) que FALLARON validación
@@ -352,24 +456,62 @@ def clean_and_validate(raw_combined: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Dat
     if raw_combined.empty:
         return raw_combined, pd.DataFrame()
 
+    # 1) Preparación por archivo (barato), agrupando resultados por tipo
+    by_type: dict[str, list[pd.DataFrame]] = {}
+    for _, part in raw_combined.groupby("__source_file", dropna=False):
+        if part.empty:
+            continue
+        df, dtype = _prepare_single_file(part)
+        by_type.setdefault(dtype, []).append(df)
+
+    # 2) Validación por tipo sobre el frame concatenado
     clean_parts = []
     invalid_parts = []
-
-    for source, part in raw_combined.groupby("__source_file", dropna=False):
-        valid, invalid = _process_single_file(part, source)
-        if not valid.empty:
-            clean_parts.append(valid)
-        if not invalid.empty:
-            invalid_parts.append(invalid)
+    for dtype, parts in by_type.items():
+        df_type = pd.concat(parts, ignore_index=True)
+        schema = _schema_for(dtype)
+        if schema is None:
+            # 'generico': no validamos estricto
+            clean_parts.append(df_type)
+            continue
+        try:
+            clean_parts.append(schema.validate(df_type, lazy=True))
+        except pa.errors.SchemaErrors as err:
+            failure = err.failure_cases.copy()
+            failure["__dataset_type"] = dtype
+
+            # Trazabilidad: aislamos los ARCHIVOS con filas fallidas;
+            # los demás archivos del mismo tipo siguen siendo válidos.
+            row_idx = failure["index"].dropna() if "index" in failure.columns else pd.Series(dtype=float)
+            if row_idx.empty and not failure.empty:
+                # Fallo a nivel de esquema (p. ej. columna ausente): todo el tipo cae
+                bad_sources = set(df_type["__source_file"].unique())
+            else:
+                bad_sources = set(df_type.loc[row_idx.astype(int), "__source_file"].unique())
+
+            bad_mask = df_type["__source_file"].isin(bad_sources)
+            invalid_parts.append(_annotate_invalid(df_type[bad_mask], failure))
+            df_ok = df_type[~bad_mask]
+            if not df_ok.empty:
+                clean_parts.append(df_ok)
 
     df_clean = pd.concat(clean_parts, ignore_index=True) if clean_parts else pd.DataFrame()
     df_invalid = pd.concat(invalid_parts, ignore_index=True) if invalid_parts else pd.DataFrame()
+
+    # Codifica como categóricas las columnas de texto repetitivo (tras la
+    # validación: los esquemas esperan String). Los valores pasan de punteros
+    # a str de Python a códigos enteros: menos memoria y groupby más rápido.
+    for col in CATEGORICAL_COLUMNS & set(df_clean.columns):
+        df_clean[col] = df_clean[col].astype("category")
     return df_clean, df_invalid
 
 # --------------------------
 # 7) Resúmenes y exportación
 # --------------------------
 
+# Tope de filas inválidas que se exportan a la pestaña 'invalid'
+MAX_INVALID_ROWS = 10_000
+
 def basic_summary(df: pd.DataFrame) -> pd.DataFrame:
     """Resumen: filas por archivo y por tipo detectado (si existe)."""
     if df.empty:
@@ -377,7 +519,9 @@ def basic_summary(df: pd.DataFrame) -> pd.DataFrame:
     cols = ["__source_file"]
     if "__dataset_type" in df.columns:
         cols.append("__dataset_type")
-    by_file = df.groupby(cols).size().reset_index(name="rows")
+    # observed=True: con columnas category, el default cruzaría TODAS las
+    # combinaciones archivo×tipo y metería filas fantasma con rows=0
+    by_file = df.groupby(cols, observed=True).size().reset_index(name="rows")
     return by_file
 
 def export_outputs(df_clean: pd.DataFrame,
@@ -393,14 +537,30 @@ def export_outputs(df_clean: pd.DataFrame,
     csv_path = PROCESSED_DIR / "combined.csv"
     xlsx_path = PROCESSED_DIR / "combined.xlsx"
 
-    # CSV limpio
-    (df_clean if not df_clean.empty else pd.DataFrame()).to_csv(csv_path, index=False)
+    # CSV limpio (pyarrow escribe multihilo y sin formatear fila a fila en Python)
+    df_out = df_clean if not df_clean.empty else pd.DataFrame()
+    if pa_csv is not None and not df_out.empty:
+        try:
+            pa_csv.write_csv(pyarrow.Table.from_pandas(df_out, preserve_index=False), str(csv_path))
+        # ArrowException cubre toda la jerarquía: las columnas object con
+        # strings y números mezclados (normales tras concatenar informes
+        # heterogéneos) lanzan ArrowTypeError, no ArrowInvalid
+        except pyarrow.ArrowException:
+            df_out.to_csv(csv_path, index=False)
+    else:
+        df_out.to_csv(csv_path, index=False)
 
-    # Excel con varias pestañas
-    with pd.ExcelWriter(xlsx_path) as writer:
-        (df_clean if not df_clean.empty else pd.DataFrame()).to_excel(writer, index=False, sheet_name="raw_clean")
+    # Excel con varias pestañas (constant_memory si xlsxwriter está disponible)
+    with pd.ExcelWriter(xlsx_path, **_XLSX_WRITER_KWARGS) as writer:
+        df_out.to_excel(writer, index=False, sheet_name="raw_clean")
         basic_summary(df_clean).to_excel(writer, index=False, sheet_name="summary")
         if df_invalid is not None and not df_invalid.empty:
-            df_invalid.to_excel(writer, index=False, sheet_name="invalid")
+            # Acotar la pestaña de inválidos: es para revisión, no un volcado
+            if len(df_invalid) > MAX_INVALID_ROWS:
+                log.warning(
+                    f"Pestaña 'invalid' truncada a {MAX_INVALID_ROWS} filas "
+                    f"(hay {len(df_invalid)}; el resto no se exporta)"
+                )
+            df_invalid.head(MAX_INVALID_ROWS).to_excel(writer, index=False, sheet_name="invalid")
 
     return csv_path, xlsx_path
\ No newline at end of file
@@ -1,17 +1,61 @@
 # src/server.py
 from __future__ import annotations
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse, parse_qs
 import json
+import threading
 import traceback
+import uuid
 
-from .main import run
+from cachetools import TTLCache
+
+# orjson serializa en C (devuelve bytes directamente); json de stdlib
+# queda como fallback si no está instalado
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Ojo: main (y con él pandas + clientes de Google) se importa de forma
+# diferida en el branch de /run: un servidor que sólo atiende /health no
+# paga el coste de arranque ni la RSS de todo el pipeline
 from .logger import get_logger
 
 log = get_logger()
 
+# Las ejecuciones del pipeline van a un pool propio: el handler no se queda
+# bloqueado y varios /run solapan su I/O (Gmail + Sheets)
+_executor = ThreadPoolExecutor(max_workers=4)
+# Ejecuciones largas que siguen vivas tras responder 202: task_id -> Future
+_tasks: dict[str, Future] = {}
+# Cuánto espera /run el resultado antes de responder 202 + task id
+RUN_WAIT_SECONDS = 60
+# Dedup de /run (cron + reintentos disparan duplicados con frecuencia):
+# mientras una ejecución siga viva, la misma query comparte SU future
+# (_inflight, sin TTL: un run largo no debe expirar y duplicarse); al
+# terminar pasa a _run_cache, donde el TTL sí empieza a contar.
+_inflight: dict[str | None, Future] = {}
+_run_cache: TTLCache = TTLCache(maxsize=64, ttl=30)
+_run_lock = threading.Lock()
+
+# /health se sondea cada pocos segundos y su respuesta nunca cambia:
+# el frame HTTP completo va precomputado como bytes y se escribe tal cual
+# (sin send_response/send_header ni serialización por petición)
+_HEALTH_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: application/json; charset=utf-8\r\n"
+    b"Content-Length: 11\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b'{"ok":true}'
+)
+
 def _json(self: BaseHTTPRequestHandler, status: int, payload: dict):
-    body = json.dumps(payload).encode("utf-8")
+    if orjson is not None:
+        body = orjson.dumps(payload)  # ya devuelve bytes
+    else:
+        body = json.dumps(payload).encode("utf-8")
     self.send_response(status)
     self.send_header("Content-Type", "application/json; charset=utf-8")
     self.send_header("Content-Length", str(len(body)))
@@ -28,16 +72,52 @@ class Handler(BaseHTTPRequestHandler):
         try:
             parsed = urlparse(self.path)
             if parsed.path == "/health":
-                return _json(self, 200, {"ok": True})
+                self.wfile.write(_HEALTH_RESPONSE)
+                self.close_connection = True
+                return
 
             if parsed.path == "/run":
                 qs = parse_qs(parsed.query)
                 query = qs.get("q", [None])[0]
                 log.info(f"/run called with q={query!r}")
-                code = run(query)  # <- tu pipeline
+                from .main import run  # import diferido (ver cabecera)
+                submitted = None
+                with _run_lock:
+                    fut = _inflight.get(query) or _run_cache.get(query)
+                    if fut is None:
+                        fut = _executor.submit(run, query)  # <- tu pipeline
+                        _inflight[query] = fut
+                        submitted = fut
+                if submitted is not None:
+                    def _archive(f, q=query):
+                        with _run_lock:
+                            _inflight.pop(q, None)
+                            _run_cache[q] = f
+                    # Registrado FUERA del lock: si el future ya terminó,
+                    # el callback corre inline en esta misma hebra y con el
+                    # lock cogido se auto-bloquearía (Lock no es reentrante)
+                    submitted.add_done_callback(_archive)
+                try:
+                    code = fut.result(timeout=RUN_WAIT_SECONDS)
+                except FutureTimeout:
+                    # Sigue corriendo: devolvemos un task id para consultarlo
+                    task_id = uuid.uuid4().hex
+                    _tasks[task_id] = fut
+                    return _json(self, 202, {"accepted": True, "task": task_id})
                 status = 200 if code == 0 else 500
                 return _json(self, status, {"code": code})
 
+            if parsed.path == "/task":
+                qs = parse_qs(parsed.query)
+                task_id = qs.get("id", [None])[0]
+                fut = _tasks.get(task_id)
+                if fut is None:
+                    return _json(self, 404, {"error": "Unknown task", "task": task_id})
+                if not fut.done():
+                    return _json(self, 200, {"task": task_id, "done": False})
+                code = _tasks.pop(task_id).result()
+                return _json(self, 200, {"task": task_id, "done": True, "code": code})
+
             return _json(self, 404, {"error": "Not found", "path": parsed.path})
 
         except Exception as e:
@@ -48,7 +128,8 @@ class Handler(BaseHTTPRequestHandler):
 
 def serve(host="0.0.0.0", port=8080):
     log.info(f"HTTP server on {host}:{port}")
-    HTTPServer((host, port), Handler).serve_forever()
+    # ThreadingHTTPServer: /health responde aunque haya un /run en marcha
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
 
 if __name__ == "__main__":
     serve()
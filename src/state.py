@@ -3,47 +3,283 @@
 cada adjunto se convierte en una huella digital (SHA-256 del contenido). Guardamos esas huellas en una SQLite (state.sqlite). Si ya vimos ese archivo, lo saltamos.'''
 
 from __future__ import annotations
-import hashlib, sqlite3, pathlib, datetime as dt
+import contextlib, hashlib, sqlite3, pathlib, threading, datetime as dt
+from typing import Iterable
+from cachetools import LRUCache
 from .config import settings
+from .logger import get_logger
 
+log = get_logger()
+
+# sha256 como BLOB (32 bytes crudos): la mitad de tamaño que el hex TEXT,
+# así el índice UNIQUE cabe mejor en page cache y compara menos bytes.
+# content_id: identidad estable del adjunto en Gmail (mensaje+nombre+tamaño).
+# content_index mapea content_id -> huella y permite saltarse descarga y
+# hash cuando el mismo adjunto reaparece; es tabla aparte porque los mismos
+# bytes pueden llegar bajo VARIAS identidades (el mismo informe adjunto a
+# dos correos) y attachments sólo guarda una fila por huella.
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS attachments (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
-  sha256 TEXT UNIQUE,
+  sha256 BLOB UNIQUE NOT NULL,
+  content_id TEXT,
   filename TEXT,
   saved_path TEXT,
   received_at TEXT
 );
+CREATE TABLE IF NOT EXISTS content_index (
+  content_id TEXT PRIMARY KEY,
+  sha256 BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sheet_digests (
+  spreadsheet_id TEXT,
+  tab_name TEXT,
+  digest BLOB,
+  PRIMARY KEY (spreadsheet_id, tab_name)
+);
 """
 
+# WAL: lecturas no bloquean escrituras; synchronous=NORMAL evita un fsync
+# por transacción (seguro con WAL); temp_store en RAM; 64MB de page cache.
+PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-64000;
+"""
+
+_SEEN_SQL = "SELECT 1 FROM attachments WHERE sha256 = ?"
+_CONTENT_SQL = "SELECT sha256 FROM content_index WHERE content_id = ?"
+_INSERT_SQL = "INSERT OR IGNORE INTO attachments (sha256, content_id, filename, saved_path, received_at) VALUES (?, ?, ?, ?, ?)"
+_MAP_SQL = "INSERT OR IGNORE INTO content_index (content_id, sha256) VALUES (?, ?)"
+
 class StateDB:
+    """
+    Mantiene UNA conexión sqlite para todo el proceso: abrir/cerrar por
+    operación re-leía cabeceras y re-adquiría locks de fichero en cada
+    seen()/add(). El lock interno serializa el acceso entre hebras
+    (las conexiones sqlite no soportan escrituras concurrentes).
+    """
+
     def __init__(self, path: pathlib.Path = settings.state_db):
         self.path = path
-        self._init()
-
-    def _init(self):
-        conn = sqlite3.connect(self.path)
-        with conn:
-            conn.executescript(SCHEMA)
-        conn.close()
-
-    def seen(self, sha256: str) -> bool:
-        conn = sqlite3.connect(self.path)
-        cur = conn.execute("SELECT 1 FROM attachments WHERE sha256 = ?", (sha256,))
-        row = cur.fetchone()
-        conn.close()
-        return row is not None
-
-    def add(self, sha256: str, filename: str, saved_path: str, received_at: str | None = None):
+        self._lock = threading.Lock()
+        # autocommit (isolation_level=None): batch() gestiona BEGIN/COMMIT
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.executescript(PRAGMAS)
+        self._conn.executescript(SCHEMA)
+        self._migrate_text_digests()
+        self._ensure_content_id()
+        # Backfill puntual: BDs anteriores guardaban content_id sólo como
+        # columna de attachments; se vuelca a content_index (idempotente).
+        # El índice idx_content sobre attachments ya no responde ninguna
+        # consulta, así que se limpia de paso.
+        self._conn.execute(
+            "INSERT OR IGNORE INTO content_index (content_id, sha256) "
+            "SELECT content_id, sha256 FROM attachments WHERE content_id IS NOT NULL"
+        )
+        self._conn.execute("DROP INDEX IF EXISTS idx_content")
+        # idx_sha sobraba: UNIQUE sobre sha256 ya crea su propio índice y
+        # mantener dos duplicaba el trabajo por insert. Se limpia de BDs
+        # que lo tengan de versiones anteriores.
+        self._conn.execute("DROP INDEX IF EXISTS idx_sha")
+        # Cache de huellas YA VISTAS (sólo positivos: una huella en la tabla
+        # nunca desaparece, así que cachearla es seguro; los negativos no se
+        # cachean por si otro proceso escribe en la misma BD).
+        self._seen_cache: LRUCache = LRUCache(maxsize=4096)
+
+    def _migrate_text_digests(self):
+        """
+        Migración puntual: BDs antiguas guardaban el sha256 como hex TEXT
+        (64 chars). Se reconvierten a BLOB de 32 bytes una sola vez.
+        """
+        ctype = next(
+            (row[2] for row in self._conn.execute("PRAGMA table_info(attachments)")
+             if row[1] == "sha256"),
+            None,
+        )
+        if ctype is None or ctype.upper() == "BLOB":
+            return
+        self._conn.execute("BEGIN")
+        try:
+            rows = self._conn.execute(
+                "SELECT sha256, filename, saved_path, received_at FROM attachments"
+            ).fetchall()
+            self._conn.execute("DROP TABLE attachments")
+            # (no executescript: haría commit implícito y rompería la transacción)
+            for stmt in SCHEMA.split(";"):
+                if stmt.strip():
+                    self._conn.execute(stmt)
+            migrated, skipped = [], 0
+            for sha, f, p, r in rows:
+                # El esquema viejo admitía NULL (y cualquier TEXT): una
+                # huella nula o corrupta no debe impedir arrancar
+                try:
+                    digest = bytes.fromhex(sha)
+                except (TypeError, ValueError):
+                    digest = b""
+                if len(digest) != 32:
+                    skipped += 1
+                    continue
+                migrated.append((digest, None, f, p, r))
+            self._conn.executemany(_INSERT_SQL, migrated)
+            if skipped:
+                log.warning(f"Migración de huellas: {skipped} filas con sha256 nulo o corrupto omitidas")
+        except BaseException:
+            self._conn.rollback()
+            raise
+        else:
+            self._conn.commit()
+
+    def _ensure_content_id(self):
+        """Añade la columna content_id a BDs creadas antes de que existiera."""
+        cols = {row[1] for row in self._conn.execute("PRAGMA table_info(attachments)")}
+        if "content_id" not in cols:
+            self._conn.execute("ALTER TABLE attachments ADD COLUMN content_id TEXT")
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Agrupa los seen/add del bloque en UNA transacción: O(1) fsyncs por
+        lote en vez de uno por adjunto.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+        try:
+            yield self
+        except BaseException:
+            with self._lock:
+                self._conn.rollback()
+            raise
+        else:
+            with self._lock:
+                self._conn.commit()
+
+    def seen(self, sha256: bytes) -> bool:
+        # Cache y conexión bajo el MISMO lock: LRUCache no es thread-safe
+        # (hasta un lookup reordena internamente la lista LRU)
+        with self._lock:
+            if sha256 in self._seen_cache:
+                return True
+            hit = self._conn.execute(_SEEN_SQL, (sha256,)).fetchone() is not None
+            if hit:
+                self._seen_cache[sha256] = True
+            return hit
+
+    def add_many(self, rows: Iterable[tuple]):
+        """
+        Inserción masiva con executemany en UNA transacción: un solo fsync
+        para N adjuntos. 'rows' son tuplas (sha256, content_id, filename,
+        saved_path, received_at). Si ya hay una transacción abierta (batch())
+        se reutiliza.
+        """
+        rows = list(rows)
+        maps = [(r[1], r[0]) for r in rows if r[1]]
+        with self._lock:
+            if self._conn.in_transaction:
+                self._conn.executemany(_INSERT_SQL, rows)
+                self._conn.executemany(_MAP_SQL, maps)
+            else:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(_INSERT_SQL, rows)
+                    self._conn.executemany(_MAP_SQL, maps)
+                except BaseException:
+                    self._conn.rollback()
+                    raise
+                else:
+                    self._conn.commit()
+            for row in rows:
+                self._seen_cache[row[0]] = True
+
+    def get_sheet_digest(self, spreadsheet_id: str, tab_name: str) -> bytes | None:
+        """Huella del último contenido subido a esa pestaña (o None)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM sheet_digests WHERE spreadsheet_id = ? AND tab_name = ?",
+                (spreadsheet_id, tab_name),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_sheet_digest(self, spreadsheet_id: str, tab_name: str, digest: bytes):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sheet_digests (spreadsheet_id, tab_name, digest) VALUES (?, ?, ?)",
+                (spreadsheet_id, tab_name, digest),
+            )
+
+    def digest_for_content(self, content_id: str) -> bytes | None:
+        """
+        Huella ya calculada para esta identidad de adjunto (mensaje+nombre+
+        tamaño), o None si nunca lo hemos ingerido. Un hit permite saltarse
+        la descarga y el hash por completo.
+        """
+        with self._lock:
+            row = self._conn.execute(_CONTENT_SQL, (content_id,)).fetchone()
+        return row[0] if row else None
+
+    def map_content(self, content_id: str, sha256: bytes):
+        """
+        Registra content_id -> huella sin fila nueva en attachments: los
+        bytes ya están ingeridos bajo otra identidad (duplicado), pero esta
+        identidad también debe acertar en digest_for_content en runs futuros.
+        """
+        with self._lock:
+            self._conn.execute(_MAP_SQL, (content_id, sha256))
+
+    def add(self, sha256: bytes, filename: str, saved_path: str,
+            received_at: str | None = None, content_id: str | None = None):
         if not received_at:
             received_at = dt.datetime.utcnow().isoformat()
-        conn = sqlite3.connect(self.path)
-        with conn:
-            conn.execute(
-                "INSERT OR IGNORE INTO attachments (sha256, filename, saved_path, received_at) VALUES (?, ?, ?, ?)",
-                (sha256, filename, saved_path, received_at),
-            )
-        conn.close()
+        with self._lock:
+            self._conn.execute(_INSERT_SQL, (sha256, content_id, filename, saved_path, received_at))
+            if content_id:
+                self._conn.execute(_MAP_SQL, (content_id, sha256))
+            self._seen_cache[sha256] = True
+
+# hashlib.sha256 ya delega en OpenSSL (EVP), que usa SHA-NI si la CPU lo
+# trae. Con settings.fast_hash="blake3" se usa BLAKE3 (AVX2/AVX-512),
+# bastante más rápido en adjuntos grandes.
+_HASH_CHUNK = 1024 * 1024  # hashear en bloques de 1 MiB: mejor localidad de caché
+
+def _new_hasher():
+    if settings.fast_hash == "blake3":
+        try:
+            import blake3
+            return blake3.blake3()
+        except ImportError:
+            pass  # caer a sha256 si blake3 no está instalado
+    return hashlib.sha256()
+
+def sha256_stream(fp) -> bytes:
+    """
+    Hashea un file-like (o cualquier objeto con .read) en bloques de 64 KiB:
+    memoria O(bloque) en vez de O(tamaño del adjunto).
+    """
+    h = _new_hasher()
+    for chunk in iter(lambda: fp.read(65536), b""):
+        h.update(chunk)
+    return h.digest()
+
+def email_digest(attachment_digests: list[bytes]) -> bytes:
+    """
+    Huella de un correo completo a partir de las huellas de sus adjuntos
+    ('hash de hashes'): se hashean 32*N bytes en vez de re-hashear los
+    adjuntos concatenados. Se ordena para que el resultado no dependa del
+    orden de descarga.
+    """
+    h = hashlib.sha256()
+    for d in sorted(attachment_digests):
+        h.update(d)
+    return h.digest()
 
-def sha256_bytes(data: bytes) -> str:
-    return hashlib.sha256(data).hexdigest()
+def sha256_bytes(data: bytes) -> bytes:
+    """
+    Huella de un buffer ya materializado (wrapper sobre el mismo backend).
+    Devuelve el digest crudo (32 bytes), que es lo que persiste StateDB.
+    """
+    h = _new_hasher()
+    view = memoryview(data)
+    for i in range(0, len(view), _HASH_CHUNK):
+        h.update(view[i:i + _HASH_CHUNK])
+    return h.digest()
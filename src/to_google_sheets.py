@@ -8,9 +8,33 @@
 *Google Sheets API* trabaja con rangos (A1 notation).'''
 
 from __future__ import annotations
-import pandas as pd
+import gzip
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
 from googleapiclient.errors import HttpError
 from .auth_gmail import sheets_service
+from .state import StateDB
+
+# pandas/numpy se importan de forma diferida dentro de las funciones que
+# los usan: importar este módulo (p. ej. desde el servidor) no debe cargar
+# todo el stack de datos
+if TYPE_CHECKING:
+    import pandas as pd
+
+state = StateDB()
+
+# Recurso spreadsheets() cacheado por hebra (misma razón que los services
+# de auth_gmail: construirlo en cada llamada es overhead repetido y el
+# http subyacente no se comparte entre hebras)
+_local = threading.local()
+
+def _svc():
+    svc = getattr(_local, "spreadsheets", None)
+    if svc is None:
+        svc = _local.spreadsheets = sheets_service().spreadsheets()
+    return svc
 
 # Funciones para crear hoja y escribir datos
 def create_or_get_sheet(spreadsheet_title: str) -> str:
@@ -18,7 +42,7 @@ def create_or_get_sheet(spreadsheet_title: str) -> str:
     Crea una Sheet vacía con ese título y devuelve su ID.
     (Si ya tienes una y conoces el ID, puedes saltarte esto y pegar el ID directo en main.py.)
     """
-    svc = sheets_service().spreadsheets()
+    svc = _svc()
     body = {"properties": {"title": spreadsheet_title}}
     try:
         res = svc.create(body=body).execute()
@@ -26,34 +50,119 @@ def create_or_get_sheet(spreadsheet_title: str) -> str:
     except HttpError as e:
         raise
 
+# Metadatos por pestaña, resueltos una vez y reutilizados en cada escritura
+@dataclass(frozen=True)
+class TabRef:
+    spreadsheet_id: str
+    tab_name: str
+    sheet_id: int
+    grid_range: dict  # rango 'pestaña completa' ya construido para updateCells
+
+_tab_refs: dict[tuple[str, str], TabRef] = {}
+
+def _make_tabref(spreadsheet_id: str, tab_name: str, sheet_id: int) -> TabRef:
+    return TabRef(
+        spreadsheet_id=spreadsheet_id,
+        tab_name=tab_name,
+        sheet_id=sheet_id,
+        grid_range={"sheetId": sheet_id, "startRowIndex": 0, "startColumnIndex": 0},
+    )
+
+def _get_tabref(spreadsheet_id: str, tab_name: str) -> TabRef:
+    """Devuelve el TabRef de la pestaña, creándola si no existe."""
+    key = (spreadsheet_id, tab_name)
+    if key in _tab_refs:
+        return _tab_refs[key]
+    ss = _svc()
+    meta = ss.get(spreadsheetId=spreadsheet_id).execute()
+    for s in meta["sheets"]:
+        props = s["properties"]
+        _tab_refs[(spreadsheet_id, props["title"])] = _make_tabref(
+            spreadsheet_id, props["title"], props["sheetId"]
+        )
+    if key not in _tab_refs:
+        add_req = {"requests": [{"addSheet": {"properties": {"title": tab_name}}}]}
+        res = ss.batchUpdate(spreadsheetId=spreadsheet_id, body=add_req).execute()
+        # la respuesta del addSheet ya trae el sheetId: sin get adicional
+        sheet_id = res["replies"][0]["addSheet"]["properties"]["sheetId"]
+        _tab_refs[key] = _make_tabref(spreadsheet_id, tab_name, sheet_id)
+    return _tab_refs[key]
+
+# Por debajo de este tamaño no compensa comprimir el body
+_GZIP_MIN_BYTES = 64 * 1024
+
+def _execute_gzipped(req):
+    """
+    Ejecuta un HttpRequest comprimiendo el body JSON con gzip si es grande:
+    la subida de hojas con miles de filas está limitada por ancho de banda
+    y el JSON de celdas (claves repetidas) comprime 3-10x.
+    """
+    body = req.body
+    if body is not None:
+        raw = body.encode("utf-8") if isinstance(body, str) else body
+        if len(raw) >= _GZIP_MIN_BYTES:
+            req.body = gzip.compress(raw)
+            req.headers["content-encoding"] = "gzip"
+    return req.execute()
+
+def _df_digest(df: pd.DataFrame) -> bytes:
+    """Huella del contenido del DataFrame (columnas + filas + índice)."""
+    import pandas as pd
+    h = hashlib.sha256()
+    h.update(",".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.digest()
+
+def _cell(v) -> dict:
+    """CellData para un valor: números como numberValue (payload más pequeño
+    y Sheets los trata como números), NaN/None como celda vacía."""
+    import numpy as np
+    if v is None or (isinstance(v, float) and v != v):
+        return {}
+    if isinstance(v, (bool, np.bool_)):
+        return {"userEnteredValue": {"boolValue": bool(v)}}
+    if isinstance(v, (int, float, np.integer, np.floating)):
+        return {"userEnteredValue": {"numberValue": float(v)}}
+    return {"userEnteredValue": {"stringValue": str(v)}}
+
 # Función para limpiar y escribir un DataFrame en una pestaña
 def clear_and_write(spreadsheet_id: str, tab_name: str, df: pd.DataFrame):
     """
     Asegura que existe la pestaña 'tab_name', limpia su contenido
     y escribe el DataFrame (encabezados + filas).
+    Todo en UNA llamada batchUpdate: un updateCells sobre la pestaña entera
+    limpia lo que no se incluya y escribe las filas nuevas (antes eran hasta
+    4 round-trips: get + addSheet + clear + update, con cuota de escritura
+    de 60/min por usuario).
     """
-    ss = sheets_service().spreadsheets()
-    vals = sheets_service().spreadsheets().values()
+    # Si el contenido no cambió desde la última subida, no hay nada que
+    # hacer: 0 llamadas a la API (y 0 cuota de escritura consumida)
+    digest = _df_digest(df)
+    if state.get_sheet_digest(spreadsheet_id, tab_name) == digest:
+        return
 
-    # 1) Asegurar que la pestaña existe
-    meta = ss.get(spreadsheetId=spreadsheet_id).execute()
-    tab_exists = any(s["properties"]["title"] == tab_name for s in meta["sheets"])
-    if not tab_exists:
-        add_req = {"requests": [{"addSheet": {"properties": {"title": tab_name}}}]}
-        ss.batchUpdate(spreadsheetId=spreadsheet_id, body=add_req).execute()
+    ref = _get_tabref(spreadsheet_id, tab_name)
 
-    # 2) Limpiar
-    vals.clear(spreadsheetId=spreadsheet_id, range=f"{tab_name}!A:ZZ").execute()
+    # Preparar datos a escribir: sin pasar por astype(str) (que clonaba el
+    # DataFrame entero como strings); los valores van tipados celda a celda
+    rows = []
+    if not df.empty:
+        header = [{"userEnteredValue": {"stringValue": str(c)}} for c in df.columns]
+        rows = [{"values": header}]
+        arr = df.to_numpy(dtype=object, copy=False)
+        rows.extend({"values": [_cell(v) for v in row]} for row in arr.tolist())
 
-    # 3) Preparar datos a escribir (todo como string por simplicidad)
-    if df.empty:
-        return
-    values = [list(df.columns)] + df.astype(str).values.tolist()
-
-    # 4) Escribir
-    vals.update(
-        spreadsheetId=spreadsheet_id,
-        range=f"{tab_name}!A1",
-        valueInputOption="RAW",
-        body={"values": values},
-    ).execute()
+    # updateCells con el rango = pestaña completa: las celdas fuera de
+    # 'rows' quedan limpias (equivale a clear + update)
+    update_req = {
+        "updateCells": {
+            "range": ref.grid_range,
+            "fields": "userEnteredValue",
+        }
+    }
+    if rows:
+        update_req["updateCells"]["rows"] = rows
+    _execute_gzipped(_svc().batchUpdate(
+        spreadsheetId=spreadsheet_id, body={"requests": [update_req]}
+    ))
+    state.set_sheet_digest(spreadsheet_id, tab_name, digest)